@@ -1,139 +1,157 @@
-import requests
-from requests.auth import HTTPDigestAuth
-import time
 import os
 import logging
-from dotenv import load_dotenv
-
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler("logs/atlas_scaler.log"),
-        logging.StreamHandler(),
-    ],
+
+from atlas_common import (
+    CLUSTER_NAME,
+    GROUP_URL,
+    WAIT_FILE_PATH,
+    ShutdownRequested,
+    create_session,
+    install_signal_handlers,
+    interruptible_sleep,
+    parse_args,
+    parse_json,
+    poll_with_backoff,
+    setup_logging,
+    wait_for_load_completion,
 )
-logger = logging.getLogger()
 
-load_dotenv()
+logger = logging.getLogger()
 
-# Atlas API Configuration
-BASE_URL = os.getenv("ATLAS_BASE_URL")
-PROJECT_ID = os.getenv("ATLAS_PROJECT_ID")
-CLUSTER_NAME = os.getenv("ATLAS_CLUSTER_NAME")
-PUBLIC_KEY = os.getenv("ATLAS_PUBLIC_KEY")
-PRIVATE_KEY = os.getenv("ATLAS_PRIVATE_KEY")
+# Scaling Configuration
 SCALE_FROM = os.getenv("SCALE_FROM", "M10")
 SCALE_TO = os.getenv("SCALE_TO", "M20")
 SLEEP_INTERVAL = int(os.getenv("SLEEP_INTERVAL", 300))
 
-# Wait file configuration
-WAIT_FILE_PATH = os.getenv("WAIT_FILE_PATH")
+CLUSTER_URL = f"{GROUP_URL}/clusters/{CLUSTER_NAME}"
 
-# Create a session with Digest Authentication
-session = requests.Session()
-session.auth = HTTPDigestAuth(PUBLIC_KEY, PRIVATE_KEY)
-session.headers.update({"Accept": "application/vnd.atlas.2024-08-05+json"})
+# Create a pooled, authenticated Atlas session
+session = create_session()
 
 
-def wait_for_load_completion():
-    if WAIT_FILE_PATH:
-        logger.info(f"Waiting for load completion file: {WAIT_FILE_PATH}")
-        while not os.path.exists(WAIT_FILE_PATH):
-            logger.info("Load completion file not found. Waiting...")
-            time.sleep(60)  # Check every minute
-        logger.info("Load completion file found. Proceeding with scaling.")
-    else:
-        logger.info("No wait file specified. Proceeding immediately.")
+# url -> (ETag, parsed body) of the last full response
+_etag_cache = {}
 
 
 def get_current_cluster_config():
-    url = f"{BASE_URL}/api/atlas/v2/groups/{PROJECT_ID}/clusters/{CLUSTER_NAME}"
-    response = session.get(url)
+    url = CLUSTER_URL
+    headers = {}
+    if url in _etag_cache:
+        headers["If-None-Match"] = _etag_cache[url][0]
+    response = session.get(url, headers=headers)
+    if response.status_code == 304:
+        return _etag_cache[url][1]
     response.raise_for_status()
-    return response.json()
+    config = parse_json(response)
+    if "ETag" in response.headers:
+        _etag_cache[url] = (response.headers["ETag"], config)
+    return config
 
 
-def update_cluster_size(new_size):
-    url = f"{BASE_URL}/api/atlas/v2/groups/{PROJECT_ID}/clusters/{CLUSTER_NAME}"
+NODE_SPEC_KEYS = ("electableSpecs", "readOnlySpecs", "analyticsSpecs")
 
-    # Get the current configuration
-    current_config = get_current_cluster_config()
 
-    # Prepare the update payload
-    payload = {}
-
-    # Update the instance size in all regionConfigs
-    for spec in current_config.get("replicationSpecs", []):
+def build_scale_payload(config, new_size):
+    # Atlas replaces replicationSpecs wholesale on PATCH, so every spec and
+    # region is copied as-is with only the instance sizes swapped. Copies keep
+    # the (possibly cached) config itself unchanged
+    replication_specs = []
+    for spec in config.get("replicationSpecs", []):
+        region_configs = []
         for region in spec.get("regionConfigs", []):
-            if "electableSpecs" in region:
-                region["electableSpecs"]["instanceSize"] = new_size
-            if "readOnlySpecs" in region:
-                region["readOnlySpecs"]["instanceSize"] = new_size
-            if "analyticsSpecs" in region:
-                region["analyticsSpecs"]["instanceSize"] = new_size
-
-    payload["replicationSpecs"] = current_config["replicationSpecs"]
+            new_region = dict(region)
+            for node_spec in NODE_SPEC_KEYS:
+                if node_spec in region:
+                    new_region[node_spec] = {
+                        **region[node_spec],
+                        "instanceSize": new_size,
+                    }
+            region_configs.append(new_region)
+        replication_specs.append({**spec, "regionConfigs": region_configs})
+    return {"replicationSpecs": replication_specs}
+
+
+def update_cluster_size(new_size, current_config):
+    url = CLUSTER_URL
+    payload = build_scale_payload(current_config, new_size)
 
     response = session.patch(url, json=payload)
+    _etag_cache.pop(url, None)
     response.raise_for_status()
-    logger.info(f"Cluster size update initiated: {new_size}")
+    logger.info("Cluster size update initiated: %s", new_size)
 
 
 def get_instance_size(config):
-    # Navigate through the config to find the instance size
-    for spec in config.get("replicationSpecs", []):
-        for config in spec.get("regionConfigs", []):
-            if "electableSpecs" in config:
-                return config["electableSpecs"]["instanceSize"]
-    return None
+    # First electable instance size across all regions, or None
+    return next(
+        (
+            region["electableSpecs"]["instanceSize"]
+            for spec in config.get("replicationSpecs", ())
+            for region in spec.get("regionConfigs", ())
+            if "electableSpecs" in region
+        ),
+        None,
+    )
+
+
+def cluster_is_idle(config):
+    if config["stateName"] == "IDLE":
+        return True
+    logger.info("Waiting for cluster update to complete...")
+    return False
 
 
 def wait_for_cluster_update():
-    while True:
-        config = get_current_cluster_config()
-        if config["stateName"] == "IDLE":
-            print("Cluster update completed")
-            break
-        logger.info("Waiting for cluster update to complete...")
-        time.sleep(60)
+    poll_with_backoff(get_current_cluster_config, cluster_is_idle)
+    print("Cluster update completed")
 
 
 def main():
+    install_signal_handlers()
     logger.info("Starting cluster scaling process")
 
-    # Wait for load completion
-    wait_for_load_completion()
+    try:
+        # Wait for load completion
+        wait_for_load_completion(WAIT_FILE_PATH)
 
-    while True:
-        try:
-            current_config = get_current_cluster_config()
-            current_size = get_instance_size(current_config)
+        while True:
+            try:
+                current_config = get_current_cluster_config()
+                current_size = get_instance_size(current_config)
 
-            if current_size is None:
-                print("Unable to determine current instance size")
-                time.sleep(SLEEP_INTERVAL)
-                continue
+                if current_size is None:
+                    print("Unable to determine current instance size")
+                    interruptible_sleep(SLEEP_INTERVAL)
+                    continue
 
-            # Toggle between M10 and M20
-            new_size = SCALE_TO if current_size == SCALE_FROM else SCALE_FROM
+                # Toggle between M10 and M20
+                new_size = SCALE_TO if current_size == SCALE_FROM else SCALE_FROM
 
-            logger.info(f"Current size: {current_size}")
-            logger.info(f"Scaling to: {new_size}")
+                logger.info("Current size: %s", current_size)
+                logger.info("Scaling to: %s", new_size)
 
-            update_cluster_size(new_size)
-            wait_for_cluster_update()
+                update_cluster_size(new_size, current_config=current_config)
+                wait_for_cluster_update()
 
-            logger.info(
-                f"Waiting for {SLEEP_INTERVAL / 60} minutes before next scaling operation..."
-            )
-            time.sleep(SLEEP_INTERVAL)
-        except Exception as e:
-            logger.info(f"An error occurred: {e}")
-            logger.info(f"Waiting for {SLEEP_INTERVAL / 60} minutes before retrying...")
-            time.sleep(SLEEP_INTERVAL)
+                logger.info(
+                    "Waiting for %s minutes before next scaling operation...",
+                    SLEEP_INTERVAL / 60,
+                )
+                interruptible_sleep(SLEEP_INTERVAL)
+            except Exception as e:
+                logger.info("An error occurred: %s", e)
+                logger.info(
+                    "Waiting for %s minutes before retrying...", SLEEP_INTERVAL / 60
+                )
+                interruptible_sleep(SLEEP_INTERVAL)
+    except ShutdownRequested:
+        logger.info("Shutdown requested. Exiting.")
 
 
 if __name__ == "__main__":
+    args = parse_args(
+        "Toggle an Atlas cluster between two instance sizes",
+        "logs/atlas_scaler.log",
+    )
+    setup_logging(args.log_file)
     main()
@@ -0,0 +1,249 @@
+import argparse
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import select
+import signal
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import AuthBase, HTTPDigestAuth
+from dotenv import load_dotenv
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:  # optional speedup: fall back to requests' stdlib json
+    orjson = None
+
+try:
+    import inotify_simple
+except ImportError:  # not Linux, or not installed: fall back to polling
+    inotify_simple = None
+
+logger = logging.getLogger()
+
+load_dotenv()
+
+# Atlas API Configuration
+BASE_URL = os.getenv("ATLAS_BASE_URL")
+PROJECT_ID = os.getenv("ATLAS_PROJECT_ID")
+CLUSTER_NAME = os.getenv("ATLAS_CLUSTER_NAME")
+PUBLIC_KEY = os.getenv("ATLAS_PUBLIC_KEY")
+PRIVATE_KEY = os.getenv("ATLAS_PRIVATE_KEY")
+# Service account credentials take precedence over the API key pair
+SA_CLIENT_ID = os.getenv("ATLAS_SA_CLIENT_ID")
+SA_CLIENT_SECRET = os.getenv("ATLAS_SA_CLIENT_SECRET")
+ATLAS_ACCEPT_HEADER = "application/vnd.atlas.2024-08-05+json"
+# Constant prefix of every project-scoped Atlas Admin API URL
+GROUP_URL = f"{BASE_URL}/api/atlas/v2/groups/{PROJECT_ID}"
+
+# Wait file configuration
+WAIT_FILE_PATH = os.getenv("WAIT_FILE_PATH")
+
+
+def parse_args(description, default_log_file):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "--log-file",
+        default=default_log_file,
+        help=f"file to write logs to (default: {default_log_file})",
+    )
+    return parser.parse_args()
+
+
+def setup_logging(log_file):
+    # Records go through a queue to a listener thread, so a slow log disk never
+    # blocks the polling loops
+    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    handlers = [logging.FileHandler(log_file), logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    atexit.register(listener.stop)
+
+    # QueueHandler pre-formats records, so leave the message untouched here
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(message)s",
+        handlers=[logging.handlers.QueueHandler(log_queue)],
+    )
+
+
+def parse_json(response):
+    if orjson is None:
+        return response.json()
+    return orjson.loads(response.content)
+
+
+class ServiceAccountAuth(AuthBase):
+    # Bearer auth from an Atlas service account, refreshed shortly before expiry
+    def __init__(self, client_id, client_secret, refresh_margin=60):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_margin = refresh_margin
+        self._token = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+
+    def ensure_token(self):
+        with self._lock:
+            if self._token is None or time.monotonic() >= self._expires_at:
+                response = requests.post(
+                    f"{BASE_URL}/api/oauth/token",
+                    auth=(self.client_id, self.client_secret),
+                    data={"grant_type": "client_credentials"},
+                    headers={"Accept": "application/json"},
+                )
+                response.raise_for_status()
+                token = parse_json(response)
+                self._token = token["access_token"]
+                self._expires_at = (
+                    time.monotonic() + token["expires_in"] - self.refresh_margin
+                )
+            return self._token
+
+    def __call__(self, r):
+        r.headers["Authorization"] = f"Bearer {self.ensure_token()}"
+        return r
+
+
+class InterruptibleRetry(Retry):
+    # urllib3 sleeps between retries with time.sleep; wait on stop_event instead
+    # and cap Retry-After like the computed backoff
+    def sleep(self, response=None):
+        retry_after = None
+        if response is not None and self.respect_retry_after_header:
+            retry_after = self.get_retry_after(response)
+        if retry_after:
+            interruptible_sleep(min(retry_after, self.backoff_max))
+        else:
+            interruptible_sleep(self.get_backoff_time())
+
+
+def create_session(pool_maxsize=8):
+    # One keep-alive pool per process. Service account tokens are reused until
+    # they near expiry; HTTPDigestAuth reuses the server nonce after the first
+    # challenge. Either way later calls skip the extra auth round trip
+    session = requests.Session()
+    if SA_CLIENT_ID and SA_CLIENT_SECRET:
+        session.auth = ServiceAccountAuth(SA_CLIENT_ID, SA_CLIENT_SECRET)
+    else:
+        session.auth = HTTPDigestAuth(PUBLIC_KEY, PRIVATE_KEY)
+    session.headers.update({"Accept": ATLAS_ACCEPT_HEADER})
+    # Atlas rate-limits per project; back off on 429s, honouring Retry-After.
+    # Only 429s are retried: a dropped connection may already have been
+    # processed, and re-sending a POST/DELETE/PATCH would then fail
+    retries = InterruptibleRetry(
+        total=None,
+        connect=0,
+        read=0,
+        other=0,
+        status=5,
+        status_forcelist=[429],
+        allowed_methods=None,
+        backoff_factor=5,
+        backoff_max=30,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retries
+        ),
+    )
+    return session
+
+
+# Set by SIGTERM/SIGINT; every wait in these scripts returns early once it is set
+stop_event = threading.Event()
+
+
+class ShutdownRequested(BaseException):
+    # BaseException, like KeyboardInterrupt, so the scripts' broad
+    # "except Exception" retry handlers don't swallow a shutdown
+    pass
+
+
+def install_signal_handlers():
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop_event.set())
+
+
+def interruptible_sleep(seconds):
+    if stop_event.wait(seconds):
+        raise ShutdownRequested
+
+
+def poll_with_backoff(fn, predicate, initial=5, factor=1.6, cap=120):
+    # Call fn until predicate(result) holds, backing off exponentially with jitter
+    attempt = 0
+    while True:
+        result = fn()
+        if predicate(result):
+            return result
+        delay = min(cap, initial * factor**attempt) * random.uniform(0.8, 1.2)
+        interruptible_sleep(delay)
+        attempt += 1
+
+
+def _poll_for_file(wait_file_path, timeout):
+    while not os.path.exists(wait_file_path):
+        logger.info("Load completion file not found. Waiting...")
+        interruptible_sleep(timeout)
+
+
+def _watch_for_file(inotify, wait_file_path, timeout):
+    # A signal can't wake a blocked read on its own (PEP 475 retries it), so
+    # also poll a pipe the interpreter writes to whenever a signal arrives
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_w, False)
+    previous_wakeup_fd = signal.set_wakeup_fd(wakeup_w)
+    try:
+        poller = select.poll()
+        poller.register(inotify.fileno(), select.POLLIN)
+        poller.register(wakeup_r, select.POLLIN)
+        logger.info("Load completion file not found. Waiting...")
+        while not os.path.exists(wait_file_path):
+            if stop_event.is_set():
+                raise ShutdownRequested
+            # One blocking wait per timeout period; no wakeups while idle
+            if not poller.poll(timeout * 1000):
+                logger.info("Load completion file not found. Waiting...")
+            # Drain directory events; the loop re-checks the file itself
+            inotify.read(timeout=0)
+    finally:
+        signal.set_wakeup_fd(previous_wakeup_fd)
+        os.close(wakeup_r)
+        os.close(wakeup_w)
+
+
+def wait_for_load_completion(wait_file_path, timeout=60):
+    if not wait_file_path:
+        logger.info("No wait file specified. Proceeding immediately.")
+        return
+
+    logger.info("Waiting for load completion file: %s", wait_file_path)
+    watch_dir = os.path.dirname(wait_file_path) or "."
+    if inotify_simple is None or not os.path.isdir(watch_dir):
+        _poll_for_file(wait_file_path, timeout)
+    else:
+        flags = inotify_simple.flags
+        with inotify_simple.INotify() as inotify:
+            try:
+                # Watch before checking so a file created in between isn't missed
+                inotify.add_watch(watch_dir, flags.CREATE | flags.MOVED_TO)
+            except OSError:
+                _poll_for_file(wait_file_path, timeout)
+            else:
+                _watch_for_file(inotify, wait_file_path, timeout)
+    logger.info("Load completion file found. Proceeding with scaling.")
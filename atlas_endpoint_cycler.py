@@ -1,43 +1,58 @@
-import requests
-from requests.auth import HTTPDigestAuth
-import time
+import functools
 import boto3
+from botocore.exceptions import ClientError
 import os
 import logging
-from dotenv import load_dotenv
-
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler("logs/atlas_endpoint_cycler.log"),
-        logging.StreamHandler(),
-    ],
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+
+from atlas_common import (
+    GROUP_URL,
+    WAIT_FILE_PATH,
+    ShutdownRequested,
+    create_session,
+    install_signal_handlers,
+    interruptible_sleep,
+    parse_args,
+    parse_json,
+    poll_with_backoff,
+    setup_logging,
+    stop_event,
+    wait_for_load_completion,
 )
-logger = logging.getLogger()
 
-load_dotenv()
+logger = logging.getLogger()
 
-# Atlas API Configuration
-BASE_URL = os.getenv("ATLAS_BASE_URL")
-PROJECT_ID = os.getenv("ATLAS_PROJECT_ID")
-CLUSTER_NAME = os.getenv("ATLAS_CLUSTER_NAME")
-PUBLIC_KEY = os.getenv("ATLAS_PUBLIC_KEY")
-PRIVATE_KEY = os.getenv("ATLAS_PRIVATE_KEY")
 # AWS Configuration
 VPC_IDS = os.getenv("VPC_IDS", "").split(",")
-SUBNET_IDS = os.getenv("SUBNET_IDS", "").split(",")
-SECURITY_GROUP_IDS = os.getenv("SECURITY_GROUP_IDS", "").split(",")
+# Per-VPC groups are comma-separated; IDs within a group (one per AZ) use "|"
+SUBNET_ID_GROUPS = os.getenv("SUBNET_IDS", "").split(",")
+SECURITY_GROUP_ID_GROUPS = os.getenv("SECURITY_GROUP_IDS", "").split(",")
+# Fail before anything is deleted rather than on a missing VPC mid-cycle
+if not len(VPC_IDS) == len(SUBNET_ID_GROUPS) == len(SECURITY_GROUP_ID_GROUPS):
+    raise ValueError(
+        "VPC_IDS, SUBNET_IDS and SECURITY_GROUP_IDS must have one "
+        f"comma-separated entry per VPC (got {len(VPC_IDS)}, "
+        f"{len(SUBNET_ID_GROUPS)} and {len(SECURITY_GROUP_ID_GROUPS)})"
+    )
+SUBNET_IDS_BY_VPC = {
+    vpc_id: subnets.split("|") for vpc_id, subnets in zip(VPC_IDS, SUBNET_ID_GROUPS)
+}
+SECURITY_GROUP_IDS_BY_VPC = {
+    vpc_id: groups.split("|")
+    for vpc_id, groups in zip(VPC_IDS, SECURITY_GROUP_ID_GROUPS)
+}
 AWS_REGION = os.getenv("AWS_REGION", "us-east-1")
 
-# Wait file configuration
-WAIT_FILE_PATH = os.getenv("WAIT_FILE_PATH")
+ENDPOINT_SERVICE_URL = f"{GROUP_URL}/privateEndpoint/AWS/endpointService"
+# Upper bound on VPCs cycled concurrently (one worker thread each)
+MAX_WORKERS = min(len(VPC_IDS), int(os.getenv("MAX_WORKERS", 16)))
+# Log (but keep waiting) once an AWS state change takes longer than this
+VPC_ENDPOINT_WAIT_WARNING = 600
 
-# Create a session with Digest Authentication
-session = requests.Session()
-session.auth = HTTPDigestAuth(PUBLIC_KEY, PRIVATE_KEY)
-session.headers.update({"Accept": "application/vnd.atlas.2024-08-05+json"})
+# Create a pooled, authenticated Atlas session
+session = create_session(pool_maxsize=MAX_WORKERS)
 
 # Initialize AWS client
 ec2_client = boto3.client(
@@ -46,135 +61,233 @@ ec2_client = boto3.client(
 )
 
 
-def wait_for_load_completion():
-    if WAIT_FILE_PATH:
-        logger.info(f"Waiting for load completion file: {WAIT_FILE_PATH}")
-        while not os.path.exists(WAIT_FILE_PATH):
-            logger.info("Load completion file not found. Waiting...")
-            time.sleep(60)  # Check every minute
-        logger.info("Load completion file found. Proceeding with scaling.")
-    else:
-        logger.info("No wait file specified. Proceeding immediately.")
-
-
+@functools.lru_cache(maxsize=1)
 def get_endpoint_service_id():
-    url = f"{BASE_URL}/api/atlas/v2/groups/{PROJECT_ID}/privateEndpoint/AWS/endpointService"
+    url = ENDPOINT_SERVICE_URL
     response = session.get(url)
     response.raise_for_status()
-    return response.json()[0]["id"]
+    return parse_json(response)[0]["id"]
 
 
+@functools.lru_cache(maxsize=1)
 def get_endpoint_service_name(endpoint_service_id):
-    url = f"{BASE_URL}/api/atlas/v2/groups/{PROJECT_ID}/privateEndpoint/AWS/endpointService/{endpoint_service_id}"
+    url = f"{ENDPOINT_SERVICE_URL}/{endpoint_service_id}"
     response = session.get(url)
     response.raise_for_status()
-    return response.json()["endpointServiceName"]
+    return parse_json(response)["endpointServiceName"]
 
 
 def get_endpoint(endpoint_service_id, vpce_id):
-    url = f"{BASE_URL}/api/atlas/v2/groups/{PROJECT_ID}/privateEndpoint/AWS/endpointService/{endpoint_service_id}/endpoint/{vpce_id}"
-    try:
-        response = session.get(url)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 404:
-            return None
-        else:
-            raise e
+    url = f"{ENDPOINT_SERVICE_URL}/{endpoint_service_id}/endpoint/{vpce_id}"
+    response = session.get(url)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return parse_json(response)
 
 
 def delete_endpoint(endpoint_service_id, vpce_id):
-    url = f"{BASE_URL}/api/atlas/v2/groups/{PROJECT_ID}/privateEndpoint/AWS/endpointService/{endpoint_service_id}/endpoint/{vpce_id}"
+    url = f"{ENDPOINT_SERVICE_URL}/{endpoint_service_id}/endpoint/{vpce_id}"
     response = session.delete(url)
     response.raise_for_status()
-    logger.info(f"Deleted private endpoint {vpce_id}")
+    logger.info("Deleted private endpoint %s", vpce_id)
 
 
 def create_private_endpoint(endpoint_service_id, vpce_id):
-    url = f"{BASE_URL}/api/atlas/v2/groups/{PROJECT_ID}/privateEndpoint/AWS/endpointService/{endpoint_service_id}/endpoint"
+    url = f"{ENDPOINT_SERVICE_URL}/{endpoint_service_id}/endpoint"
     payload = {
         "id": vpce_id,
     }
     response = session.post(url, json=payload)
     response.raise_for_status()
-    logger.info(f"Created private endpoint {vpce_id}")
-    return response.json()
+    logger.info("Created private endpoint %s", vpce_id)
+    return parse_json(response)
+
 
+# vpc_id -> vpce_id of the endpoints this process created. Only VPCs missing
+# from it (e.g. right after a restart) need a DescribeVpcEndpoints lookup
+_vpce_state = {}
+_vpce_state_lock = threading.Lock()
 
-def get_vpc_endpoint_id(vpc_id, service_name):
-    response = ec2_client.describe_vpc_endpoints(
+# Set from a worker thread as soon as any VPC of the current cycle fails
+_cycle_failed = threading.Event()
+
+
+def get_vpc_endpoint_ids(vpc_ids, service_name):
+    # One paginated DescribeVpcEndpoints call covering every VPC
+    paginator = ec2_client.get_paginator("describe_vpc_endpoints")
+    vpce_ids = {}
+    for page in paginator.paginate(
         Filters=[
-            {"Name": "vpc-id", "Values": [vpc_id]},
+            {"Name": "vpc-id", "Values": vpc_ids},
             {"Name": "service-name", "Values": [service_name]},
         ]
-    )
+    ):
+        for endpoint in page["VpcEndpoints"]:
+            vpce_ids.setdefault(endpoint["VpcId"], endpoint["VpcEndpointId"])
+    return vpce_ids
+
+
+def get_vpc_endpoint_state(vpc_endpoint_id):
+    try:
+        response = ec2_client.describe_vpc_endpoints(VpcEndpointIds=[vpc_endpoint_id])
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "InvalidVpcEndpointId.NotFound":
+            return None
+        raise
     endpoints = response["VpcEndpoints"]
-    if endpoints:
-        return endpoints[0]["VpcEndpointId"]
-    return None
+    return endpoints[0]["State"].lower() if endpoints else None
+
+
+def wait_for_vpc_endpoint_state(vpc_endpoint_id, states):
+    # Interruptible, unbounded polling: a slow AWS/Atlas transition is logged
+    # rather than turned into an error that stops the cycler
+    started = time.monotonic()
+
+    def reached(state):
+        if state in states:
+            return True
+        waited = time.monotonic() - started
+        if waited > VPC_ENDPOINT_WAIT_WARNING:
+            logger.warning(
+                "AWS VPC endpoint %s still %s after %d minutes. Waiting...",
+                vpc_endpoint_id,
+                state,
+                waited // 60,
+            )
+        return False
+
+    poll_with_backoff(lambda: get_vpc_endpoint_state(vpc_endpoint_id), reached)
 
 
 def delete_aws_vpc_endpoint(vpc_endpoint_id):
     ec2_client.delete_vpc_endpoints(VpcEndpointIds=[vpc_endpoint_id])
-    logger.info(f"Deleted AWS VPC endpoint {vpc_endpoint_id}")
+    with _vpce_state_lock:
+        for vpc_id, vpce_id in list(_vpce_state.items()):
+            if vpce_id == vpc_endpoint_id:
+                del _vpce_state[vpc_id]
+    logger.info("Deleted AWS VPC endpoint %s", vpc_endpoint_id)
 
 
 def create_aws_vpc_endpoint(
-    vpc_id, subnet_id, security_group_id, atlas_endpoint_service_name
+    vpc_id, subnet_ids, security_group_ids, atlas_endpoint_service_name
 ):
+    # A single call places the endpoint in every subnet (AZ) of the VPC
     response = ec2_client.create_vpc_endpoint(
         VpcEndpointType="Interface",
         VpcId=vpc_id,
         ServiceName=atlas_endpoint_service_name,
-        SubnetIds=[subnet_id],
-        SecurityGroupIds=[security_group_id],
+        SubnetIds=subnet_ids,
+        SecurityGroupIds=security_group_ids,
     )
     vpc_endpoint_id = response["VpcEndpoint"]["VpcEndpointId"]
-    logger.info(f"Created AWS VPC endpoint {vpc_endpoint_id}")
+    with _vpce_state_lock:
+        _vpce_state[vpc_id] = vpc_endpoint_id
+    logger.info("Created AWS VPC endpoint %s", vpc_endpoint_id)
     return vpc_endpoint_id
 
 
+def cycle_one(vpc_id, vpce_id, endpoint_service_id, endpoint_service_name):
+    # Queued VPCs must not start tearing down endpoints once shutdown began,
+    # or once another VPC in this cycle has failed
+    if stop_event.is_set():
+        raise ShutdownRequested
+    if _cycle_failed.is_set():
+        return
+    try:
+        _cycle_vpc(vpc_id, vpce_id, endpoint_service_id, endpoint_service_name)
+    except BaseException:
+        # Flag it from this worker, before it can pick up another queued VPC
+        _cycle_failed.set()
+        raise
+
+
+def _cycle_vpc(vpc_id, vpce_id, endpoint_service_id, endpoint_service_name):
+    if vpce_id:
+        logger.info("Deleting Private Endpoint %s...", vpce_id)
+        delete_endpoint(endpoint_service_id, vpce_id)
+        poll_with_backoff(
+            lambda: get_endpoint(endpoint_service_id, vpce_id),
+            lambda endpoint: not endpoint,
+        )
+        delete_aws_vpc_endpoint(vpce_id)
+        wait_for_vpc_endpoint_state(vpce_id, (None, "deleted"))
+
+    logger.info("Recreating Private Endpoint in VPC %s...", vpc_id)
+    vpce_id = create_aws_vpc_endpoint(
+        vpc_id,
+        SUBNET_IDS_BY_VPC[vpc_id],
+        SECURITY_GROUP_IDS_BY_VPC[vpc_id],
+        endpoint_service_name,
+    )
+    create_private_endpoint(endpoint_service_id, vpce_id)
+    # The AWS side only turns available once Atlas has accepted the connection
+    wait_for_vpc_endpoint_state(vpce_id, ("available",))
+    poll_with_backoff(
+        lambda: get_endpoint(endpoint_service_id, vpce_id),
+        lambda endpoint: endpoint and endpoint["connectionStatus"] == "AVAILABLE",
+    )
+
+
 def cycle_private_endpoints():
+    install_signal_handlers()
     logger.info("Starting private endpoint cycling process")
 
-    # Wait for load completion if WAIT_FILE_PATH is set
-    wait_for_load_completion()
-
-    endpoint_service_id = get_endpoint_service_id()
-    print(f"Using Endpoint Service ID: {endpoint_service_id}")
-    endpoint_service_name = get_endpoint_service_name(endpoint_service_id)
-
-    while True:
-        for vpc_id in VPC_IDS:
-            vpce_id = get_vpc_endpoint_id(vpc_id, endpoint_service_name)
-            if vpce_id:
-                logger.info(f"Deleting Private Endpoint {vpce_id}...")
-                delete_endpoint(endpoint_service_id, vpce_id)
-                while True:
-                    endpoint = get_endpoint(endpoint_service_id, vpce_id)
-                    if not endpoint:
-                        break
-                    time.sleep(30)
-                delete_aws_vpc_endpoint(vpce_id)
-
-        time.sleep(120)
-        for i, vpc_id in enumerate(VPC_IDS):
-            logger.info(f"Recreating Private Endpoint in VPC {vpc_id}...")
-            vpce_id = create_aws_vpc_endpoint(
-                vpc_id, SUBNET_IDS[i], SECURITY_GROUP_IDS[i], endpoint_service_name
-            )
-            create_private_endpoint(endpoint_service_id, vpce_id)
-            while True:
-                endpoint = get_endpoint(endpoint_service_id, vpce_id)
-                if endpoint and endpoint["connectionStatus"] == "AVAILABLE":
-                    break
-                time.sleep(30)
-
-        # Wait before next cycle
-        logger.info("Waiting for 5 minutes before next cycle...")
-        time.sleep(300)  # 5 minutes
+    # VPCs are independent, so cycle up to MAX_WORKERS of them at once. The
+    # pool lives for the whole run so each worker thread keeps its Digest
+    # nonce (HTTPDigestAuth stores it per thread) from one cycle to the next
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    try:
+        # Wait for load completion if WAIT_FILE_PATH is set
+        wait_for_load_completion(WAIT_FILE_PATH)
+
+        endpoint_service_id = get_endpoint_service_id()
+        print(f"Using Endpoint Service ID: {endpoint_service_id}")
+        endpoint_service_name = get_endpoint_service_name(endpoint_service_id)
+
+        while True:
+            with _vpce_state_lock:
+                vpce_ids = dict(_vpce_state)
+            unknown_vpc_ids = [vpc_id for vpc_id in VPC_IDS if vpc_id not in vpce_ids]
+            if unknown_vpc_ids:
+                vpce_ids.update(
+                    get_vpc_endpoint_ids(unknown_vpc_ids, endpoint_service_name)
+                )
+
+            _cycle_failed.clear()
+            futures = [
+                executor.submit(
+                    cycle_one,
+                    vpc_id,
+                    vpce_ids.get(vpc_id),
+                    endpoint_service_id,
+                    endpoint_service_name,
+                )
+                for vpc_id in VPC_IDS
+            ]
+            # Return on the first failure in any worker, not in submission order
+            done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+            failed = [
+                future for future in futures if future in done and future.exception()
+            ]
+            if failed:
+                # Drop VPCs still queued so they aren't cycled after a failure
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise failed[0].exception()
+
+            # Wait before next cycle
+            logger.info("Waiting for 5 minutes before next cycle...")
+            interruptible_sleep(300)  # 5 minutes
+    except ShutdownRequested:
+        logger.info("Shutdown requested. Exiting.")
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
 
 
 if __name__ == "__main__":
+    args = parse_args(
+        "Periodically delete and recreate Atlas AWS private endpoints",
+        "logs/atlas_endpoint_cycler.log",
+    )
+    setup_logging(args.log_file)
     cycle_private_endpoints()